@@ -31,20 +31,74 @@ import sys
 import errno
 import argparse
 import subprocess
-import tarfile
 
 import StreamDecompressor
 
+# NOTE: tarfile and time are imported lazily on the code paths needing
+#   them, to keep the startup of the common `restoredb plain.sql` case
+#   free of their import cost
+
 try:
     import pgheader
-    import time
 except ImportError:
     pgheader = None
 
 __all__ = """
-    PostgreSQLDump PostgreSQLTarDump PlainSQL pgdump_guesser open parser run
+    PostgreSQLDump PostgreSQLTarDump PlainSQL FastXZ
+    pgdump_guesser open parser run
 """.split()
 
+_PGDMP_MAGIC = b'PGDMP'
+
+try:
+    _DEVNULL = subprocess.DEVNULL
+except AttributeError:
+    # python 2 has no subprocess.DEVNULL; open it once, write mode
+    _DEVNULL = io.open(os.devnull, 'wb')
+
+# extra command-line arguments for pg_restore, filled once by run()
+_pg_restore_extra_args = []
+
+# pg_dump archive format codes (format 2 is unassigned)
+_FORMATS = ('UNKNOWN', 'CUSTOM', None, 'TAR', 'NULL', 'DIRECTORY')
+
+# banner printed on stderr for dumps carrying a parseable header
+_HEADER_TEMPLATE = (
+    ";\n"
+    "; Archive created at {createDate}\n"
+    ";     dbname: {archdbname}\n"
+    ";     TOC Entries:\n"
+    ";     Compression: {compression}\n"
+    ";     Dump Version: {vmaj}.{vmin}-{vrev}\n"
+    ";     Format: {format}\n"
+    ";     Integer: {intSize} bytes\n"
+    ";     Offset: {offSize} bytes\n"
+    ";     Dumped from database version: {archiveDumpVersion}\n"
+    ";     Dumped by pg_dump version: {archiveRemoteVersion}\n"
+    ";\n"
+)
+
+
+class _PeekReader(object):
+    """
+    Minimal read-only file-like over an already-peeked buffer.
+
+    pgheader.ArchiveHandle only ever calls read(); serving it through a
+    memoryview avoids copying the 16000-byte peek into an io.BytesIO
+    before a single byte is parsed.
+    """
+    def __init__(self, buf, offset=0):
+        self._view = memoryview(buf)
+        self._pos = offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            chunk = self._view[self._pos:]
+        else:
+            chunk = self._view[self._pos:self._pos + size]
+        self._pos += len(chunk)
+        return chunk.tobytes()
+
 
 class PostgreSQLDump(StreamDecompressor.ExternalPipe):
     """
@@ -60,12 +114,17 @@ class PostgreSQLDump(StreamDecompressor.ExternalPipe):
 
     def __init__(self, name, fileobj, toc_pos=0):
         if pgheader:
+            peeked = getattr(fileobj, '_cached_header', None)
+            if peeked is None:
+                peeked = fileobj.peek(toc_pos + 16000)
             self.header = pgheader.ArchiveHandle(
-                io.BytesIO(fileobj.peek(16000)[toc_pos:]))
+                _PeekReader(peeked, toc_pos))
             self.header.ReadHead()
         else:
             self.header = None
-        self.__command__[0] = self.find_pg_restore()
+        # per-instance argv: leave the class attribute untouched so
+        # repeated invocations do not accumulate arguments
+        self.__command__ = [self.find_pg_restore()] + _pg_restore_extra_args
         super(PostgreSQLDump, self).__init__(name, fileobj)
 
     def find_pg_restore(self):
@@ -74,9 +133,12 @@ class PostgreSQLDump(StreamDecompressor.ExternalPipe):
     @classmethod
     def __guess__(cls, mime, name, fileobj, toc_pos=0):
         realname = super(PostgreSQLDump, cls).__guess__(mime, name, fileobj)
-        magic = fileobj.peek(5)[toc_pos:]
-        if not magic[:5] == 'PGDMP':
+        header = fileobj.peek(toc_pos + 16000)
+        if not header.startswith(_PGDMP_MAGIC, toc_pos):
             raise ValueError("not a postgres custom dump")
+        # __init__ parses the same bytes for the dump header, spare it a
+        # second decompressor-level peek
+        fileobj._cached_header = header
         return realname
 
 
@@ -93,6 +155,7 @@ class PostgreSQLTarDump(PostgreSQLDump):
     __extensions__ = ['tar']
 
     def __init__(self, name, fileobj):
+        import tarfile
         super(PostgreSQLTarDump, self)\
             .__init__(name, fileobj, toc_pos=tarfile.BLOCKSIZE)
 
@@ -100,8 +163,14 @@ class PostgreSQLTarDump(PostgreSQLDump):
     def __guess__(cls, mime, name, fileobj):
         if mime not in cls.__mimes__:
             raise ValueError("not a tar file")
-        tarinfo = tarfile.TarInfo.frombuf(
-            fileobj.peek(tarfile.BLOCKSIZE)[:tarfile.BLOCKSIZE])
+        import tarfile
+        buf = fileobj.peek(tarfile.BLOCKSIZE)
+        if len(buf) > tarfile.BLOCKSIZE:
+            # peek may return more than asked for; frombuf wants a single
+            # header block, so trim through a memoryview to copy 512 bytes
+            # at most instead of re-slicing the whole peek
+            buf = memoryview(buf)[:tarfile.BLOCKSIZE].tobytes()
+        tarinfo = tarfile.TarInfo.frombuf(buf)
         if not tarinfo.name == 'toc.dat':
             raise ValueError("does not look like a tar dump")
         return super(PostgreSQLTarDump, cls).__guess__(
@@ -126,10 +195,33 @@ class PlainSQL(StreamDecompressor.Archive):
             self.header = None
         super(PlainSQL, self).__init__(name, fileobj, fileobj)
 
+    @classmethod
+    def __guess__(cls, mime, name, fileobj):
+        # loop prevention first: once the stream is already plain SQL
+        # there is no point paying the MIME/extension dispatch again
+        if type(fileobj) is cls:
+            raise ValueError("stream is already plain SQL")
+        return super(PlainSQL, cls).__guess__(mime, name, fileobj)
+
+
+class FastXZ(StreamDecompressor.ExternalPipe):
+    """
+    Decompress xz streams with the multi-threaded xz decoder.
+
+    Same pipe as the stock unxz decompressor but passes --threads=0 so
+    multi-block .xz/.tar.xz dumps decode one block per core (xz >= 5.4;
+    older versions accept the flag and simply stay single-threaded).
+    """
+    __compression__ = 'xz'
+    __mimes__ = ['application/x-xz']
+    __extensions__ = ['xz']
+    __command__ = 'xz --decompress --threads=0 --stdout'.split()
+
 
 pgdump_guesser = StreamDecompressor.Guesser(
     extra_decompressors=[
         (-10, PostgreSQLTarDump),
+        ( -5, FastXZ),
         (  0, PostgreSQLDump),
         (  0, PlainSQL),
     ],
@@ -170,7 +262,8 @@ parser.add_argument('--debug', action='store_true',
 parser.add_argument('dump', nargs='?')
 
 def warn(*messages):
-    sys.stderr.write(" ".join(map(unicode, messages))+"\n")
+    sys.stderr.write(" ".join(unicode(m) for m in messages))
+    sys.stderr.write("\n")
 
 def die(*messages):
     warn(*messages)
@@ -180,22 +273,111 @@ def debug(*messages):
     if args.debug:
         warn("debug:", *messages)
 
+def _pump(src, dst_fd, bufsize=262144):
+    """
+    Copy src to the file descriptor dst_fd in large fixed-size blocks.
+
+    Iterating the archive line-by-line costs one object allocation and one
+    small write() per line of dump; this moves 256KB per call instead.  When
+    the source exposes a real file descriptor and the platform supports it,
+    os.splice moves the data entirely in-kernel.
+
+    NOTE: an io_uring-batched feed was considered but rejected: the feed is
+          a single sequential pipe, so only one splice can usefully be in
+          flight at a time and a submission queue cannot overlap anything.
+          The win of batching is already captured by the 256KB block size.
+    """
+    splice = getattr(os, 'splice', None)
+    if splice is not None and hasattr(src, 'fileno'):
+        src_fd = saved = None
+        try:
+            # the guesser leaves peeked bytes buffered ahead of the raw
+            # descriptor, and BufferedReader.seek never moves the
+            # descriptor for in-buffer targets: lseek it to the logical
+            # position explicitly or splice would skip those bytes
+            if src.seekable():
+                src_fd = src.fileno()
+                saved = os.lseek(src_fd, 0, os.SEEK_CUR)
+                os.lseek(src_fd, src.tell(), os.SEEK_SET)
+        except (IOError, OSError, io.UnsupportedOperation):
+            src_fd = None
+        if src_fd is not None:
+            spliced = 0
+            try:
+                while True:
+                    count = splice(src_fd, dst_fd, bufsize)
+                    if not count:
+                        return
+                    spliced += count
+            except OSError, exc:
+                if spliced or exc.errno != errno.EINVAL:
+                    raise
+                # not a pipe-compatible pair of descriptors: put the
+                # descriptor back where the buffered layer expects it
+                # and copy in user-space instead
+                os.lseek(src_fd, saved, os.SEEK_SET)
+    while True:
+        chunk = src.read(bufsize)
+        if not chunk:
+            break
+        while chunk:
+            chunk = chunk[os.write(dst_fd, chunk):]
+
+def _sendfile(archive, dst_fd, bufsize=262144):
+    """
+    Zero-copy fast path for plain uncompressed SQL files.
+
+    When no decompression is needed the bytes never have to enter
+    user-space: os.sendfile moves them straight from the dump file to the
+    destination descriptor.  Returns True when the whole stream was sent
+    this way, False when the caller should fall back to _pump.
+    """
+    sendfile = getattr(os, 'sendfile', None)
+    if sendfile is None or archive.compressions != ['sql']:
+        return False
+    try:
+        if not archive.seekable():
+            return False
+        # lseek the raw descriptor to the logical position explicitly:
+        # the guessers leave peeked bytes buffered ahead of it, and
+        # BufferedReader.seek never moves the descriptor for in-buffer
+        # targets, so sendfile would skip those bytes otherwise
+        src_fd = archive.fileno()
+        saved = os.lseek(src_fd, 0, os.SEEK_CUR)
+        os.lseek(src_fd, archive.tell(), os.SEEK_SET)
+    except (IOError, OSError, io.UnsupportedOperation):
+        return False
+    sent = 0
+    try:
+        while True:
+            count = sendfile(dst_fd, src_fd, None, bufsize)
+            if not count:
+                return True
+            sent += count
+    except OSError, exc:
+        if sent or exc.errno not in (errno.EINVAL, errno.ENOSYS):
+            raise
+        # nothing was sent: put the descriptor back where the buffered
+        # layer expects it so the fallback copy reads a coherent stream
+        os.lseek(src_fd, saved, os.SEEK_SET)
+        return False
+
 def run(args):
     if args.help:
         parser.print_help()
         sys.exit(0)
 
     if args.no_owner:
-        PostgreSQLDump.__command__.append('--no-owner')
+        _pg_restore_extra_args.append('--no-owner')
 
     if args.no_privileges:
-        PostgreSQLDump.__command__.append('--no-privileges')
+        _pg_restore_extra_args.append('--no-privileges')
 
     if args.clean:
-        PostgreSQLDump.__command__.append('--clean')
+        _pg_restore_extra_args.append('--clean')
 
     if args.create:
-        PostgreSQLDump.__command__.append('--create')
+        _pg_restore_extra_args.append('--create')
 
     if args.dump:
         try:
@@ -204,7 +386,10 @@ def run(args):
             die(args.dump+':', exc.strerror)
     else:
         try:
-            archive = open(fileobj=sys.stdin)
+            # read the raw byte stream, not a text wrapper doing newline
+            # translation (sys.stdin has no buffer attribute on python 2,
+            # where stdin is already binary)
+            archive = open(fileobj=getattr(sys.stdin, 'buffer', sys.stdin))
         except IOError, exc:
             die('-:', exc.strerror)
 
@@ -212,40 +397,26 @@ def run(args):
     debug("compressions:", *archive.compressions)
 
     if archive.header and not args.no_header:
+        import time
         header = dict(archive.header.__dict__,
             createDate=time.ctime(archive.header.createDate),
-            format={
-                0 : 'UNKNOWN',
-                1 : 'CUSTOM',
-                3 : 'TAR',
-                4 : 'NULL',
-                5 : 'DIRECTORY',
-            }[archive.header.format])
-        sys.stderr.write(
-            ";\n"
-            "; Archive created at %(createDate)s\n"
-            ";     dbname: %(archdbname)s\n"
-            ";     TOC Entries:\n"
-            ";     Compression: %(compression)s\n"
-            ";     Dump Version: %(vmaj)d.%(vmin)d-%(vrev)d\n"
-            ";     Format: %(format)s\n"
-            ";     Integer: %(intSize)d bytes\n"
-            ";     Offset: %(offSize)d bytes\n"
-            ";     Dumped from database version: %(archiveDumpVersion)s\n"
-            ";     Dumped by pg_dump version: %(archiveRemoteVersion)s\n"
-            ";\n"
-            % header
-        )
+            format=_FORMATS[archive.header.format])
+        sys.stderr.write(_HEADER_TEMPLATE.format(**header))
 
     if 'pgdump' in archive.compressions:
-        debug("pg_restore arguments:", PostgreSQLDump.__command__)
+        debug("pg_restore arguments:",
+              PostgreSQLDump.__command__ + _pg_restore_extra_args)
 
     if (not args.dbname and not os.isatty(sys.stdout.fileno())) or \
        args.dbname == '-':
         try:
-            sys.stdout.writelines(archive)
+            sys.stdout.flush()
+            if not _sendfile(archive, sys.stdout.fileno()):
+                _pump(archive, sys.stdout.fileno())
             sys.exit(0)
-        except IOError, e:
+        # NOTE: os.write raises OSError, not IOError; EnvironmentError
+        #   covers both so a broken pipe still dies cleanly
+        except EnvironmentError, e:
             archive.close()
             die(e.args[1])
     else:
@@ -261,14 +432,26 @@ def run(args):
             command_args += ['--username', args.username]
 
         debug("command arguments:", command_args)
-        # NOTE: can't use stdin=archive because it doesn't flush line-by-line
+        # NOTE: keep stdin=PIPE rather than stdin=archive: feeding the pipe
+        #   ourselves lets _sendfile/_pump move fixed 256KB blocks (or stay
+        #   in-kernel entirely) instead of whatever read pattern psql uses
         psql = subprocess.Popen(command_args,
-            stdin=subprocess.PIPE, stdout=io.open(os.devnull))
+            stdin=subprocess.PIPE, stdout=_DEVNULL)
+        try:
+            import fcntl
+            # grow the pipe from the 64KB linux default so the producer
+            # blocks less often; needs fs.pipe-max-size >= 1MB, so treat
+            # refusal as non-fatal (F_SETPIPE_SZ == 1031)
+            fcntl.fcntl(psql.stdin.fileno(),
+                        getattr(fcntl, 'F_SETPIPE_SZ', 1031), 1 << 20)
+        except (ImportError, IOError, OSError):
+            pass
         try:
-            psql.stdin.writelines(archive)
-            debug("psql: finished writing lines, closing...")
+            if not _sendfile(archive, psql.stdin.fileno()):
+                _pump(archive, psql.stdin.fileno())
+            debug("psql: finished writing, closing...")
             psql.stdin.close()
-        except IOError, e:
+        except EnvironmentError, e:
             archive.close()
             die(e.args[1])
         retcode = psql.wait()
@@ -0,0 +1,137 @@
+import io
+import os
+import sys
+import errno
+import unittest2
+import subprocess
+import tempfile
+from distutils.spawn import find_executable
+
+import restoredb
+
+
+RESTOREDB = [sys.executable] + [os.environ.get('RESTOREDB', 'restoredb.py')]
+
+SQL = b"SELECT 1;\n" * 4096
+
+
+def make_dump(data=SQL, suffix='.sql'):
+    temp = tempfile.NamedTemporaryFile(suffix=suffix, delete=False)
+    temp.write(data)
+    temp.close()
+    return temp.name
+
+
+class PumpTests(unittest2.TestCase):
+    def setUp(self):
+        self.name = make_dump()
+        self.addCleanup(os.unlink, self.name)
+
+    def _read_pipe(self, fill):
+        r, w = os.pipe()
+        try:
+            fill(w)
+        finally:
+            os.close(w)
+        with io.FileIO(r, 'r') as fd:
+            return fd.read()
+
+    def test_pump_copies_all_bytes(self):
+        out = self._read_pipe(lambda w: restoredb._pump(io.BytesIO(SQL), w))
+        self.assertEqual(out, SQL)
+
+    def test_pump_preserves_peeked_bytes(self):
+        # the guesser peeks ahead of the logical position; the feed must
+        # not skip nor duplicate those bytes
+        archive = restoredb.open(name=self.name)
+        out = self._read_pipe(lambda w: restoredb._pump(archive, w))
+        self.assertEqual(out, SQL)
+
+    def test_pump_broken_pipe_raises_environmenterror(self):
+        head = subprocess.Popen(['head', '-c', '50'],
+            stdin=subprocess.PIPE, stdout=restoredb._DEVNULL)
+        try:
+            with self.assertRaises(EnvironmentError) as caught:
+                restoredb._pump(io.BytesIO(b"x" * (1 << 21)),
+                                head.stdin.fileno())
+            self.assertEqual(caught.exception.errno, errno.EPIPE)
+        finally:
+            head.stdin.close()
+            head.wait()
+
+    def test_cli_broken_pipe_dies_cleanly(self):
+        big = make_dump(SQL * 64)
+        self.addCleanup(os.unlink, big)
+        shell = subprocess.Popen(
+            "%s %s | head -c 50 > /dev/null"
+            % (" ".join(RESTOREDB), big),
+            shell=True, stderr=subprocess.PIPE)
+        stderr = shell.communicate()[1]
+        self.assertNotIn(b"Traceback", stderr)
+
+
+class SendfileTests(unittest2.TestCase):
+    def setUp(self):
+        self.name = make_dump()
+        self.addCleanup(os.unlink, self.name)
+
+    @unittest2.skipIf(hasattr(os, 'sendfile'), "os.sendfile available")
+    def test_declined_without_os_support(self):
+        archive = restoredb.open(name=self.name)
+        r, w = os.pipe()
+        try:
+            self.assertFalse(restoredb._sendfile(archive, w))
+        finally:
+            os.close(r)
+            os.close(w)
+
+    def test_declined_for_compressed_input(self):
+        archive = restoredb.open(name=self.name)
+        archive.compressions = ['gzip', 'sql']
+        r, w = os.pipe()
+        try:
+            self.assertFalse(restoredb._sendfile(archive, w))
+        finally:
+            os.close(r)
+            os.close(w)
+
+
+class PeekReaderTests(unittest2.TestCase):
+    def test_reads_from_offset(self):
+        reader = restoredb._PeekReader(b"PGDMPabcdef", 5)
+        self.assertEqual(reader.read(3), b"abc")
+        self.assertEqual(reader.read(), b"def")
+        self.assertEqual(reader.read(4), b"")
+
+
+class GuessTests(unittest2.TestCase):
+    def test_pgdmp_magic_accepted(self):
+        fileobj = restoredb.StreamDecompressor.ArchiveFile(
+            io.BytesIO(b"PGDMP" + b"\x01" * 100), 'x.pgdump')
+        self.assertEqual(restoredb.PostgreSQLDump.__guess__(
+            'application/octet-stream', 'x.pgdump', fileobj), 'x')
+
+    def test_pgdmp_magic_rejected(self):
+        fileobj = restoredb.StreamDecompressor.ArchiveFile(
+            io.BytesIO(b"NOTDM" * 30), 'y.pgdump')
+        with self.assertRaises(ValueError):
+            restoredb.PostgreSQLDump.__guess__(
+                'application/octet-stream', 'y.pgdump', fileobj)
+
+    def test_plainsql_not_guessed_twice(self):
+        name = make_dump()
+        self.addCleanup(os.unlink, name)
+        archive = restoredb.open(name=name)
+        with self.assertRaises(ValueError):
+            restoredb.PlainSQL.__guess__('text/plain', name, archive)
+
+
+class FastXZTests(unittest2.TestCase):
+    @unittest2.skipUnless(find_executable('xz'), "xz is not installed")
+    def test_xz_dump_decompressed(self):
+        name = make_dump()
+        subprocess.check_call(['xz', name])
+        self.addCleanup(os.unlink, name + '.xz')
+        archive = restoredb.open(name=name + '.xz')
+        self.assertEqual(archive.compressions, ['xz', 'sql'])
+        self.assertEqual(archive.read(), SQL)